@@ -0,0 +1,759 @@
+#!/usr/bin/env python
+
+# revision: $Id$
+
+import sys
+import argparse
+import os
+import time
+import random
+import re
+import json
+import urllib
+import urlparse
+import shutil
+import tempfile
+import threading
+import subprocess
+import xmlrpclib
+import SocketServer
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+import dita2confluence
+
+prog_description = '''
+    Benchmarks dita2confluence without a confluence server. It generates a
+    synthetic DITA xhtml output (an index.html TOC plus topic files with
+    images, xref attachments and tables) and publishes it to an in-process
+    mock of the confluence xmlrpc and REST api. For every size it reports
+    the time of parse_toc, the conversion throughput, the end-to-end
+    publish time and the peak RSS of the publish.
+'''
+
+TOPIC_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en-us" lang="en-us">
+<head><meta name="DC.Title" content="%(title)s"/><title>%(title)s</title></head>
+<body id="%(id)s"><h1 class="title topictitle1">%(title)s</h1>
+<div class="body"><p class="p">This is <kbd class="ph kbd">topic</kbd> %(id)s.</p>
+%(images)s
+<p class="p">%(links)s</p>
+%(table)s
+</div>
+</body>
+</html>
+'''
+
+
+def generate_output(directory, pages, depth=3, fanout=10, images=2,
+                    attachments=1, table_rows=20):
+    '''
+    write a synthetic DITA xhtml output with "pages" topics to directory and
+    return the path of its index.html. The topics form a tree of at most
+    "depth" levels with "fanout" children per topic. Every topic shows
+    "images" images, of which the first is shared by all topics, links to
+    "attachments" files and to its previous topic, and holds a table with
+    "table_rows" rows.
+    '''
+    for sub in ('topics', 'images', 'files'):
+        if not os.path.isdir(os.path.join(directory, sub)):
+            os.makedirs(os.path.join(directory, sub))
+    with open(os.path.join(directory, 'images', 'logo.png'), 'wb') as f:
+        f.write('\x89PNG shared logo' * 64)
+
+    # breadth first assignment of topics to the levels of the tree
+    children = {None: []}
+    queue = [(None, 0)]
+    count = 0
+    while count < pages:
+        parent, level = queue.pop(0)
+        for i in range(fanout if parent is not None else pages):
+            if count == pages:
+                break
+            children[parent].append(count)
+            children[count] = []
+            if level + 1 < depth:
+                queue.append((count, level + 1))
+            count += 1
+            if parent is None and count >= fanout:
+                break
+        if not queue:
+            break
+
+    for n in range(count):
+        name = 'topic%05d' % n
+        imgs = ''.join(
+            '<img src="../images/%s"/>' % (
+                'logo.png' if i == 0 else '%s_%d.png' % (name, i))
+            for i in range(images))
+        for i in range(1, images):
+            with open(os.path.join(directory, 'images',
+                                   '%s_%d.png' % (name, i)), 'wb') as f:
+                f.write('\x89PNG %s %d' % (name, i) * 32)
+        links = ['<a class="xref" href="topic%05d.html">Topic %d</a>' % (
+            max(n - 1, 0), max(n - 1, 0))]
+        for i in range(attachments):
+            fname = '%s_%d.pdf' % (name, i)
+            with open(os.path.join(directory, 'files', fname), 'wb') as f:
+                f.write('%PDF ' + name * 64)
+            links.append('<a class="xref" href="../files/%s">%s</a>' % (
+                fname, fname))
+        rows = ''.join(
+            '<tr><td class="entry">%d</td><td class="entry">row %d of '
+            '<span class="keyword">%s</span></td></tr>' % (r, r, name)
+            for r in range(table_rows))
+        table = '<table class="table" border="1">%s</table>' % rows
+        with open(os.path.join(directory, 'topics', name + '.html'),
+                  'w') as f:
+            f.write(TOPIC_TEMPLATE % {
+                "id": name,
+                "title": 'Topic %d' % n,
+                "images": '<p class="p">%s</p>' % imgs,
+                "links": ' '.join(links),
+                "table": table,
+            })
+
+    def toc_list(parent):
+        items = []
+        for n in children[parent]:
+            sub = toc_list(n) if children[n] else ''
+            items.append('<li><a href="topics/topic%05d.html">Topic %d</a>'
+                         '%s</li>\n' % (n, n, sub))
+        return '<ul>\n%s</ul>\n' % ''.join(items)
+
+    index = os.path.join(directory, 'index.html')
+    with open(index, 'w') as f:
+        f.write(TOPIC_TEMPLATE.split('<div')[0] % {
+            "id": 'index', "title": 'Benchmark Manual'})
+        f.write(toc_list(None))
+        f.write('</body>\n</html>\n')
+    return index
+
+
+class MockConfluence(object):
+    '''
+    In-memory implementation of the confluence2 xmlrpc methods used by
+    dita2confluence. Every call sleeps "latency" seconds to simulate the
+    round trip to a real server. The space "space_key" initially holds a
+    home page and the page "root_title" below it. If "session_calls" is
+    given, a session token expires after that number of calls.
+    '''
+
+    def __init__(self, space_key='BENCH', root_title='Root', latency=0,
+                 session_calls=None):
+        self.space_key = space_key
+        self.latency = latency
+        self.session_calls = session_calls
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.pages = {}
+        self.children = {}
+        self.attachments = {}
+        self.calls = {}
+        self.next_id = 1
+        home = self.create({'title': 'Home', 'parentId': '0'})
+        self.create({'title': root_title, 'parentId': home['id']})
+
+    def _dispatch(self, method, params):
+        if not method.startswith('confluence2.'):
+            raise xmlrpclib.Fault(0, 'unknown method ' + method)
+        name = method.split('.', 1)[1]
+        if name.startswith('_') or not hasattr(self, name):
+            raise xmlrpclib.Fault(0, 'unknown method ' + method)
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if name != 'login':
+                self.use_session(params[0])
+            return getattr(self, name)(*params)
+
+    def use_session(self, token):
+        calls = self.sessions.get(token)
+        if calls is None or (self.session_calls is not None and
+                             calls >= self.session_calls):
+            raise xmlrpclib.Fault(0, 'com.atlassian.confluence.rpc.'
+                                  'AuthenticationFailedException: User not '
+                                  'authenticated or session expired. Call '
+                                  'login() to open a new session')
+        self.sessions[token] = calls + 1
+
+    def create(self, page):
+        page = dict(page)
+        page['id'] = str(self.next_id)
+        self.next_id += 1
+        page['version'] = '1'
+        page['space'] = self.space_key
+        page['url'] = 'http://mock/pages/' + page['id']
+        self.pages[page['id']] = page
+        self.children.setdefault(page['parentId'], []).append(page['id'])
+        self.children[page['id']] = []
+        return page
+
+    def summary(self, page):
+        return dict((k, page[k]) for k in
+                    ('id', 'title', 'parentId', 'space', 'url'))
+
+    def find(self, title):
+        for page in self.pages.values():
+            if page['title'].lower() == title.lower():
+                return page
+        return None
+
+    def login(self, user, password):
+        token = 'mock-token-%d' % (len(self.sessions))
+        self.sessions[token] = 0
+        return token
+
+    def getSpace(self, token, space_key):
+        return {'key': space_key, 'name': space_key, 'homePage': '1'}
+
+    def getPages(self, token, space_key):
+        return [self.summary(p) for p in self.pages.values()]
+
+    def getPage(self, token, *args):
+        if len(args) == 1:
+            page = self.pages.get(args[0])
+        else:
+            page = self.find(args[1])
+        if page is None:
+            raise xmlrpclib.Fault(0, 'page not found')
+        return page
+
+    def getChildren(self, token, page_id):
+        return [self.summary(self.pages[c])
+                for c in self.children.get(page_id, [])]
+
+    def getDescendents(self, token, page_id):
+        result = []
+        stack = list(reversed(self.children.get(page_id, [])))
+        while stack:
+            page_id = stack.pop()
+            result.append(self.summary(self.pages[page_id]))
+            stack.extend(reversed(self.children.get(page_id, [])))
+        return result
+
+    def storePage(self, token, page):
+        if not page.get('id'):
+            if self.find(page['title']) is not None:
+                raise xmlrpclib.Fault(0, 'a page with this title exists')
+            return self.create(page)
+        old = self.pages.get(page['id'])
+        if old is None:
+            raise xmlrpclib.Fault(0, 'page not found')
+        if old['parentId'] != page['parentId']:
+            self.children[old['parentId']].remove(old['id'])
+            self.children[page['parentId']].append(old['id'])
+        old.update(page)
+        old['version'] = str(int(old['version']) + 1)
+        return old
+
+    def addAttachment(self, token, page_id, attachment, data):
+        attachment = dict(attachment)
+        attachment['pageId'] = page_id
+        attachment['fileSize'] = str(len(data.data))
+        attachment['id'] = str(self.next_id)
+        self.next_id += 1
+        self.attachments.setdefault(page_id, {})[
+            attachment['fileName']] = attachment
+        return attachment
+
+    def getAttachments(self, token, page_id):
+        return self.attachments.get(page_id, {}).values()
+
+    def movePage(self, token, page_id, target_id, position):
+        page = self.pages[page_id]
+        self.children[page['parentId']].remove(page_id)
+        if position in ('above', 'below'):
+            parent_id = self.pages[target_id]['parentId']
+            siblings = self.children[parent_id]
+            index = siblings.index(target_id)
+            siblings.insert(index + (position == 'below'), page_id)
+        else:
+            parent_id = target_id
+            self.children[parent_id].append(page_id)
+        page['parentId'] = parent_id
+        return True
+
+    def removePage(self, token, page_id):
+        page = self.pages.pop(page_id)
+        self.children[page['parentId']].remove(page_id)
+        # like confluence, the children move to the parent of the page
+        for child in self.children.pop(page_id, []):
+            self.pages[child]['parentId'] = page['parentId']
+            self.children[page['parentId']].append(child)
+        return True
+
+
+class MockRestApi(object):
+    '''
+    The REST endpoints of confluence that dita2confluence uses, on the pages
+    of a MockConfluence. Calls are counted in the "calls" of the
+    MockConfluence as "rest." and the name of their route. Listings return
+    at most "limit" results per response with a "next" link holding the
+    offset of the next ones. If "move" is False, the move endpoint is missing, like
+    on confluence servers before version 7.
+    '''
+
+    ROUTES = [
+        ('GET', r'/user/current$', 'current_user'),
+        ('GET', r'/space/(?P<key>[^/]+)$', 'space'),
+        ('GET', r'/content$', 'find'),
+        ('POST', r'/content$', 'create'),
+        ('GET', r'/content/(?P<id>\d+)$', 'get'),
+        ('PUT', r'/content/(?P<id>\d+)$', 'update'),
+        ('DELETE', r'/content/(?P<id>\d+)$', 'delete'),
+        ('GET', r'/content/(?P<id>\d+)/child/page$', 'children'),
+        ('GET', r'/content/(?P<id>\d+)/descendant/page$', 'descendants'),
+        ('GET', r'/content/(?P<id>\d+)/child/attachment$', 'attachments'),
+        ('PUT', r'/content/(?P<id>\d+)/child/attachment$', 'attach'),
+        ('PUT', r'/content/(?P<id>\d+)/move/(?P<position>\w+)/'
+         r'(?P<target>\d+)$', 'move'),
+    ]
+    MAX_LIMIT = 100
+
+    def __init__(self, confluence, move=True):
+        self.confluence = confluence
+        self.move_supported = move
+        self.routes = [(method, re.compile('^/rest/api' + path), name)
+                       for method, path, name in self.ROUTES]
+
+    def handle(self, method, url, headers, body):
+        '''
+        return the (status, json result) of the request
+        '''
+        path, _, query = url.partition('?')
+        query = dict(urlparse.parse_qsl(query))
+        for route_method, pattern, name in self.routes:
+            match = pattern.match(path)
+            if route_method == method and match:
+                break
+        else:
+            return 404, {"message": "no such endpoint: " + path}
+        if name == 'move' and not self.move_supported:
+            return 404, {"message": "no such endpoint: " + path}
+        if not headers.get('authorization', '').startswith('Basic '):
+            return 401, {"message": "login required"}
+        confluence = self.confluence
+        if confluence.latency:
+            time.sleep(confluence.latency)
+        with confluence.lock:
+            key = 'rest.' + name
+            confluence.calls[key] = confluence.calls.get(key, 0) + 1
+            return getattr(self, name)(query, body, **match.groupdict())
+
+    def content(self, page, expand):
+        confluence = self.confluence
+        expand = expand.split(',') if expand else []
+        content = {
+            "id": page['id'],
+            "type": "page",
+            "status": "current",
+            "title": page['title'],
+            "_links": {"webui": "/pages/viewpage.action?pageId=" +
+                       page['id']},
+            "_expandable": {"space": "/rest/api/space/" +
+                            confluence.space_key},
+        }
+        if 'space' in expand:
+            content['space'] = {"key": confluence.space_key,
+                                "name": confluence.space_key}
+        if 'version' in expand:
+            content['version'] = {"number": int(page['version'])}
+        if 'ancestors' in expand:
+            ancestors = []
+            parent_id = page['parentId']
+            while parent_id in confluence.pages:
+                parent = confluence.pages[parent_id]
+                ancestors.insert(0, {"id": parent['id'], "type": "page",
+                                     "title": parent['title']})
+                parent_id = parent['parentId']
+            content['ancestors'] = ancestors
+        if 'body.storage' in expand:
+            content['body'] = {"storage": {
+                "value": page.get('content', ''),
+                "representation": "storage"}}
+        return content
+
+    def listing(self, path, query, pages):
+        start = int(query.get('start', 0))
+        limit = min(int(query.get('limit', 25)), self.MAX_LIMIT)
+        results = [self.content(p, query.get('expand'))
+                   for p in pages[start:start + limit]]
+        links = {"context": ""}
+        if start + limit < len(pages):
+            links['next'] = '/rest/api%s?%s' % (path, urllib.urlencode(
+                dict(query, start=start + limit, limit=limit)))
+        return 200, {"results": results, "start": start, "limit": limit,
+                     "size": len(results), "_links": links}
+
+    def page(self, page_id):
+        return self.confluence.pages.get(page_id)
+
+    def current_user(self, query, body):
+        return 200, {"type": "known", "username": "mock"}
+
+    def space(self, query, body, key):
+        if key != self.confluence.space_key:
+            return 404, {"message": "no space " + key}
+        return 200, {"key": key, "name": key, "homepage": {"id": "1"}}
+
+    def find(self, query, body):
+        pages = sorted(self.confluence.pages.values(),
+                       key=lambda p: int(p['id']))
+        if 'title' in query:
+            pages = [p for p in pages if p['title'] == query['title']]
+        return self.listing('/content', query, pages)
+
+    def get(self, query, body, id):
+        page = self.page(id)
+        if page is None:
+            return 404, {"message": "page not found"}
+        return 200, self.content(page, query.get('expand'))
+
+    def create(self, query, body):
+        content = json.loads(body)
+        if self.confluence.find(content['title']) is not None:
+            return 400, {"message": "a page with this title exists"}
+        page = self.confluence.create({
+            "title": content['title'],
+            "parentId": content['ancestors'][-1]['id'],
+            "content": content['body']['storage']['value'],
+        })
+        return 200, self.content(page, query.get('expand'))
+
+    def update(self, query, body, id):
+        content = json.loads(body)
+        page = self.page(id)
+        if page is None:
+            return 404, {"message": "page not found"}
+        if content['version']['number'] != int(page['version']) + 1:
+            return 409, {"message": "version %s is not the next version" % (
+                content['version']['number'])}
+        result = self.confluence.storePage(None, {
+            "id": id,
+            "title": content['title'],
+            "parentId": content['ancestors'][-1]['id'],
+            "content": content['body']['storage']['value'],
+        })
+        return 200, self.content(result, query.get('expand'))
+
+    def delete(self, query, body, id):
+        if self.page(id) is None:
+            return 404, {"message": "page not found"}
+        self.confluence.removePage(None, id)
+        return 204, None
+
+    def children(self, query, body, id):
+        return self.listing('/content/%s/child/page' % (id), query, [
+            self.page(c) for c in self.confluence.children.get(id, [])])
+
+    def descendants(self, query, body, id):
+        pages = []
+        stack = list(reversed(self.confluence.children.get(id, [])))
+        while stack:
+            page_id = stack.pop()
+            pages.append(self.page(page_id))
+            stack.extend(reversed(self.confluence.children.get(page_id, [])))
+        return self.listing('/content/%s/descendant/page' % (id), query,
+                            pages)
+
+    def attachment(self, attachment):
+        return {
+            "id": attachment['id'],
+            "type": "attachment",
+            "title": attachment['fileName'],
+            "metadata": {"comment": attachment.get('comment', ''),
+                         "mediaType": attachment.get('contentType')},
+            "extensions": {"fileSize": int(attachment['fileSize']),
+                           "comment": attachment.get('comment', ''),
+                           "mediaType": attachment.get('contentType')},
+        }
+
+    def attachments(self, query, body, id):
+        attachments = sorted(
+            self.confluence.attachments.get(id, {}).values(),
+            key=lambda a: int(a['id']))
+        start = int(query.get('start', 0))
+        limit = min(int(query.get('limit', 25)), self.MAX_LIMIT)
+        links = {}
+        if start + limit < len(attachments):
+            links['next'] = '/rest/api/content/%s/child/attachment?%s' % (
+                id, urllib.urlencode(dict(query, start=start + limit)))
+        return 200, {"results": [self.attachment(a) for a in
+                                 attachments[start:start + limit]],
+                     "_links": links}
+
+    def attach(self, query, body, id):
+        fields = parse_multipart(body)
+        filename, data = fields['file']
+        attachment = self.confluence.addAttachment(
+            None, id, {"fileName": filename,
+                       "comment": fields.get('comment', (None, ''))[1]},
+            xmlrpclib.Binary(data))
+        return 200, {"results": [self.attachment(attachment)]}
+
+    def move(self, query, body, id, position, target):
+        positions = {'before': 'above', 'after': 'below',
+                     'append': 'append'}
+        self.confluence.movePage(None, id, target, positions[position])
+        return 200, {"pageId": id}
+
+
+def parse_multipart(body):
+    '''
+    return the fields of a multipart/form-data body by name, as (filename,
+    value) tuples
+    '''
+    boundary = body[2:body.index('\r\n')]
+    fields = {}
+    for part in body.split('--' + boundary)[1:-1]:
+        head, _, value = part[2:].partition('\r\n\r\n')
+        name = re.search(r'name="([^"]*)"', head).group(1)
+        filename = re.search(r'filename="([^"]*)"', head)
+        fields[name] = (filename.group(1) if filename else None,
+                        value[:-2])
+    return fields
+
+
+class MockRequestHandler(SimpleXMLRPCRequestHandler):
+    # keep-alive, like a real confluence server
+    protocol_version = 'HTTP/1.1'
+    rpc_paths = ('/rpc/xmlrpc',)
+
+    def admit(self):
+        '''
+        count the request as active, or refuse it with 503 if the server is
+        at its capacity. A share of "error_rate" requests fails with 500.
+        '''
+        server = self.server
+        with server.lock:
+            refuse = server.capacity is not None and \
+                server.active >= server.capacity
+            fail = not refuse and random.random() < server.error_rate
+            if refuse:
+                server.refused += 1
+            elif fail:
+                server.failed += 1
+            else:
+                server.active += 1
+        if refuse:
+            # like an overloaded server behind a load balancer
+            self.rfile.read(int(self.headers.get('content-length', 0)))
+            self.send_response(503)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif fail:
+            # like a proxy that lost its backend, before the call was done
+            self.rfile.read(int(self.headers.get('content-length', 0)))
+            self.send_response(500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        return not (refuse or fail)
+
+    def leave(self):
+        with self.server.lock:
+            self.server.active -= 1
+
+    def do_POST(self):
+        if self.path.startswith('/rest/'):
+            return self.do_REST()
+        if not self.admit():
+            return
+        try:
+            SimpleXMLRPCRequestHandler.do_POST(self)
+        finally:
+            self.leave()
+
+    def do_REST(self):
+        if not self.admit():
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get('content-length', 0)))
+            status, result = self.server.rest.handle(
+                self.command, self.path, self.headers, body)
+            data = json.dumps(result) if result is not None else ''
+            self.send_response(status)
+            if data:
+                self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        finally:
+            self.leave()
+
+    do_GET = do_PUT = do_DELETE = do_REST
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer):
+    '''
+    threaded xmlrpc server serving a MockConfluence on localhost, with the
+    REST api of MockRestApi below /rest/api. The url of its xmlrpc service
+    is in "url". If a capacity is given, requests beyond
+    that number of concurrent requests are refused with 503 and counted in
+    "refused". A share of "error_rate" requests fails with 500, counted in
+    "failed".
+    '''
+    daemon_threads = True
+
+    def __init__(self, confluence, port=0, capacity=None, rest_move=True,
+                 error_rate=0):
+        SimpleXMLRPCServer.__init__(self, ('127.0.0.1', port),
+                                    MockRequestHandler, allow_none=True,
+                                    logRequests=False)
+        self.register_instance(confluence)
+        self.confluence = confluence
+        self.rest = MockRestApi(confluence, move=rest_move)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.active = 0
+        self.refused = 0
+        self.failed = 0
+        self.url = 'http://127.0.0.1:%d/rpc/xmlrpc' % self.server_address[1]
+
+    def handle_error(self, request, client_address):
+        # clients that are killed or close idle connections are expected
+        pass
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+def bench_parse_toc(index):
+    start = time.time()
+    toc = dita2confluence.parse_toc(index, os.path.dirname(index))
+    return toc, time.time() - start
+
+
+def bench_convert(toc):
+    '''
+    convert all topics in this process, without the prints of the
+    converter, and return (seconds, pages, bytes of html)
+    '''
+    paths = [link['path'] for link in toc['flat_toc']]
+    size = sum(os.path.getsize(p) for p in paths)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        for path in paths:
+            dita2confluence.convert_topic(path)
+        seconds = time.time() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return seconds, len(paths), size
+
+
+def bench_publish(index, url, work_dir, jobs, extra_args=()):
+    '''
+    publish with dita2confluence in a child process and return the wall
+    clock time and the peak RSS in kilobytes of that process
+    '''
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'dita2confluence.py')
+    command = [sys.executable, script, '-u', 'bench', '-p', 'bench',
+               '-s', 'BENCH', '-r', 'Root', '--url', url,
+               '--work-dir', work_dir, '--jobs', str(jobs)]
+    command.extend(extra_args)
+    command.append(index)
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        process = subprocess.Popen(command, stdout=devnull)
+        pid, status, usage = os.wait4(process.pid, 0)
+        seconds = time.time() - start
+    if status != 0:
+        raise Exception('publish failed with status %d' % (status))
+    return seconds, usage.ru_maxrss
+
+
+def run(size, args):
+    directory = tempfile.mkdtemp(prefix='dita2confluence-bench-')
+    try:
+        index = generate_output(directory, size, depth=args.depth,
+                                fanout=args.fanout, images=args.images,
+                                attachments=args.attachments,
+                                table_rows=args.table_rows)
+        toc, parse_seconds = bench_parse_toc(index)
+        convert_seconds, pages, html_bytes = bench_convert(toc)
+
+        server = MockServer(MockConfluence(latency=args.latency,
+                                           session_calls=args.session_calls),
+                            capacity=args.capacity,
+                            rest_move=not args.no_rest_move,
+                            error_rate=args.error_rate).start()
+        try:
+            publish_seconds, rss = bench_publish(
+                index, server.url, os.path.join(directory, 'work'),
+                args.jobs, args.extra)
+            calls = dict(server.confluence.calls)
+            refused = server.refused
+        finally:
+            server.shutdown()
+            server.server_close()
+    finally:
+        shutil.rmtree(directory)
+    return {
+        "pages": pages,
+        "parse_toc_seconds": parse_seconds,
+        "convert_pages_per_second": pages / max(convert_seconds, 1e-9),
+        "convert_mb_per_second":
+            html_bytes / 1048576.0 / max(convert_seconds, 1e-9),
+        "publish_seconds": publish_seconds,
+        "publish_peak_rss_mb": rss / 1024.0,
+        "rpc_calls": calls,
+        "refused_requests": refused,
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=prog_description)
+    parser.add_argument('--sizes', dest='sizes', default='100,1000,10000', help='comma separated numbers of topics to benchmark')
+    parser.add_argument('--depth', dest='depth', type=int, default=3, help='maximum depth of the generated TOC')
+    parser.add_argument('--fanout', dest='fanout', type=int, default=10, help='number of children per generated topic')
+    parser.add_argument('--images', dest='images', type=int, default=2, help='images per topic, the first one is shared by all topics')
+    parser.add_argument('--attachments', dest='attachments', type=int, default=1, help='xref attachments per topic')
+    parser.add_argument('--table-rows', dest='table_rows', type=int, default=20, help='rows of the table in every topic')
+    parser.add_argument('--latency', dest='latency', type=float, default=0, help='seconds the mock server sleeps per call')
+    parser.add_argument('--capacity', dest='capacity', type=int, default=None, help='concurrent requests the mock server accepts before it answers 503')
+    parser.add_argument('--error-rate', dest='error_rate', type=float, default=0, help='share of the requests the mock server fails with 500, between 0 and 1')
+    parser.add_argument('--session-calls', dest='session_calls', type=int, default=None, help='calls after which a session token of the mock server expires')
+    parser.add_argument('--no-rest-move', dest='no_rest_move', action='store_true', default=False, help='leave out the move endpoint of the REST api of the mock server, like confluence before version 7')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=1, help='passed to dita2confluence --jobs')
+    parser.add_argument('--json', dest='json_out', default=None, help='also write the results to this json file')
+    parser.add_argument('--generate', dest='generate', default=None, help='only generate a DITA output of the first size in this directory')
+    parser.add_argument('extra', nargs=argparse.REMAINDER, help='further arguments for dita2confluence, after "--"')
+    args = parser.parse_args()
+    args.extra = [a for a in args.extra if a != '--']
+
+    sizes = [int(n) for n in args.sizes.split(',')]
+    if args.generate:
+        print generate_output(args.generate, sizes[0], depth=args.depth,
+                              fanout=args.fanout, images=args.images,
+                              attachments=args.attachments,
+                              table_rows=args.table_rows)
+        sys.exit(0)
+
+    results = []
+    print "%8s %10s %10s %10s %10s %10s" % (
+        'pages', 'toc s', 'pages/s', 'MB/s', 'publish s', 'RSS MB')
+    for size in sizes:
+        result = run(size, args)
+        results.append(result)
+        print "%8d %10.3f %10.1f %10.2f %10.2f %10.1f" % (
+            result['pages'], result['parse_toc_seconds'],
+            result['convert_pages_per_second'],
+            result['convert_mb_per_second'], result['publish_seconds'],
+            result['publish_peak_rss_mb'])
+    if args.json_out:
+        with open(args.json_out, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
@@ -0,0 +1,1165 @@
+'''
+tests of dita2confluence. The expected output in tests/golden was produced
+by the original minidom based code of storePage and parse_toc, so the
+golden tests prove that the streaming conversion still produces the same
+storage format and TocBuilder the same toc. The minidom code failed on the
+link texts of topics/cdata.html, its output was checked by hand.
+
+run them with: python -m unittest discover tests
+'''
+import glob
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import xmlrpclib
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import dita2confluence
+import dita2confluence_bench
+
+GOLDEN = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'golden')
+
+
+def quietly(func, *args, **kwargs):
+    # the conversion prints its progress, failed tasks their traceback
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = StringIO()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+
+def read_text(path):
+    with io.open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def read_json(path):
+    with io.open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def relative(files):
+    return [{"name": f['name'],
+             "path": os.path.relpath(f['path'], GOLDEN)} for f in files]
+
+
+class ConvertTopicTest(unittest.TestCase):
+    '''
+    every tests/golden/topics/<name>.html is converted to the storage format
+    in <name>.xml, with the title, images and attachments in <name>.json
+    '''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def topics(self):
+        topics = sorted(glob.glob(os.path.join(GOLDEN, 'topics', '*.html')))
+        self.assertTrue(topics)
+        return topics
+
+    def check(self, html_file, result):
+        base = os.path.splitext(html_file)[0]
+        expected = read_json(base + '.json')
+        content = result['content']
+        if isinstance(content, dita2confluence.PageBody):
+            content = content.read()
+        self.assertEqual(read_text(base + '.xml'), content + u'\n')
+        self.assertEqual(expected['title'], result['title'])
+        self.assertEqual(expected['images'], relative(result['images']))
+        self.assertEqual(expected['attachments'],
+                         relative(result['attachments']))
+
+    def test_in_memory(self):
+        for html_file in self.topics():
+            result = quietly(dita2confluence.convert_topic, html_file)
+            self.check(html_file, result)
+
+    def test_streamed_to_file(self):
+        for html_file in self.topics():
+            content_file = os.path.join(self.tmp, 'content.xml')
+            result = quietly(dita2confluence.convert_topic, html_file,
+                             content_file)
+            self.check(html_file, result)
+
+
+class LinkTableTest(unittest.TestCase):
+    '''
+    the resolution of the local links of the topics of a toc
+    '''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.topics = os.path.join(self.tmp, 'topics')
+        self.work_dir = os.path.join(self.tmp, '.dita2confluence')
+        for path in ('topics/a.html', 'topics/b.html', 'topics/other.html',
+                     'files/release notes.txt', '.dita2confluence/state.json',
+                     '.dita2confluence/bundles/a.json'):
+            path = os.path.join(self.tmp, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write('<html/>')
+        self.table = dita2confluence.LinkTable(
+            {os.path.join(self.topics, 'a.html'): u'Page A',
+             os.path.join(self.topics, 'b.html'): u'Page B'},
+            self.tmp, exclude=[self.work_dir])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def resolve(self, href, xref=True):
+        return self.table.resolve(self.topics, href, xref)
+
+    def test_not_local(self):
+        for href in ('http://www.example.com/a.html', 'mailto:a@example.com',
+                     '', '#', None):
+            self.assertIsNone(self.resolve(href))
+
+    def test_anchor(self):
+        self.assertEqual({"href": "#a__s1", "xref": False,
+                          "anchor": "a__s1"},
+                         self.resolve('#a__s1', False))
+
+    def test_page(self):
+        path = os.path.join(self.topics, 'b.html')
+        self.assertEqual({"href": "b.html#b__s1", "xref": True,
+                          "path": path, "page": u"Page B",
+                          "anchor": "b__s1"},
+                         self.resolve('b.html#b__s1'))
+        self.assertEqual({"href": "../topics/b.html", "xref": False,
+                          "path": path, "page": u"Page B", "anchor": None},
+                         self.resolve('../topics/b.html', False))
+
+    def test_attachment(self):
+        self.assertEqual({"href": "../files/release%20notes.txt",
+                          "xref": True,
+                          "attachment": os.path.join(
+                              self.tmp, 'files', 'release notes.txt')},
+                         self.resolve('../files/release%20notes.txt'))
+
+    def test_unresolved(self):
+        for href, xref in (
+                # a page outside the toc, a missing file or page
+                ('other.html', True), ('missing.txt', True),
+                ('missing.html#s1', True),
+                # only xref links without fragment are attachments
+                ('../files/release%20notes.txt', False),
+                ('../files/release%20notes.txt#s1', True)):
+            link = self.resolve(href, xref)
+            self.assertTrue(link['unresolved'], href)
+            self.assertNotIn('attachment', link)
+
+    def test_work_dir_not_scanned(self):
+        self.assertEqual(
+            set([os.path.join(self.topics, name)
+                 for name in ('a.html', 'b.html', 'other.html')] +
+                [os.path.join(self.tmp, 'files', 'release notes.txt')]),
+            self.table.files)
+        # files in the work dir are looked up on disk instead
+        link = self.resolve('../.dita2confluence/state.json')
+        self.assertEqual(os.path.join(self.work_dir, 'state.json'),
+                         link['attachment'])
+
+    def test_valid(self):
+        links = [self.resolve('b.html#b__s1'),
+                 self.resolve('../files/release%20notes.txt')]
+        html_file = os.path.join(self.topics, 'a.html')
+        self.assertTrue(self.table.valid(html_file, links))
+        table = dita2confluence.LinkTable(
+            {os.path.join(self.topics, 'b.html'): u'Renamed'}, self.tmp)
+        self.assertFalse(table.valid(html_file, links))
+
+    def test_link_titles(self):
+        html_file = os.path.join(self.topics, 'a.html')
+        with open(html_file, 'w') as f:
+            f.write('<html><head><title>A</title></head><body><p>'
+                    '<a class="xref" href="b.html#b__s1">the  second\n'
+                    'topic</a> '
+                    '<a class="xref" href="other.html">Other  topic</a> '
+                    '<a href="#a__s1">this <b>topic</b></a></p>'
+                    '</body></html>')
+        result = quietly(dita2confluence.convert_topic, html_file,
+                         links=self.table)
+        # a page by its title, other links by the page titled like the
+        # link text
+        self.assertEqual(
+            u'<body><p>'
+            u'<ac:link ac:anchor="b__s1"><ri:page ri:content-title="Page B"/>'
+            u'<ac:plain-text-link-body><![CDATA[the second topic]]>'
+            u'</ac:plain-text-link-body></ac:link> '
+            u'<ac:link><ri:page ri:content-title="Other topic"/>'
+            u'<ac:plain-text-link-body><![CDATA[Other topic]]>'
+            u'</ac:plain-text-link-body></ac:link> '
+            u'<ac:link ac:anchor="a__s1">'
+            u'<ac:plain-text-link-body><![CDATA[this topic]]>'
+            u'</ac:plain-text-link-body></ac:link></p></body>',
+            result['content'])
+        href = lambda link: link['href']
+        self.assertEqual(
+            sorted([self.resolve('b.html#b__s1'), self.resolve('other.html'),
+                    self.resolve('#a__s1', False)], key=href),
+            sorted(result['links'], key=href))
+
+
+def plain(node, basedir):
+    # the toc as json, with paths relative to basedir
+    if isinstance(node, list):
+        return [plain(n, basedir) for n in node]
+    if hasattr(node, 'keys'):
+        result = dict((key, plain(node[key], basedir))
+                      for key in node.keys() if key != 'flat_toc')
+        if 'path' in result:
+            result['path'] = os.path.relpath(result['path'], basedir)
+        return result
+    return node
+
+
+class ParseTocTest(unittest.TestCase):
+    '''
+    every tests/golden/toc/<name>.html is parsed to the toc and flat toc in
+    <name>.json, labels of entries without a link included
+    '''
+
+    def test_golden(self):
+        basedir = os.path.join(GOLDEN, 'toc')
+        tocs = sorted(glob.glob(os.path.join(basedir, '*.html')))
+        self.assertTrue(tocs)
+        for toc_file in tocs:
+            expected = read_json(os.path.splitext(toc_file)[0] + '.json')
+            toc = quietly(dita2confluence.parse_toc, toc_file, basedir)
+            self.assertEqual(expected['toc'], plain(toc, basedir))
+            self.assertEqual(expected['flat_toc'],
+                             plain(toc['flat_toc'], basedir))
+
+    def test_deep(self):
+        # deeper than the recursion limit
+        depth = sys.getrecursionlimit() + 100
+        tmp = tempfile.mkdtemp()
+        try:
+            toc_file = os.path.join(tmp, 'index.html')
+            with open(toc_file, 'w') as f:
+                f.write('<html><head><title>Deep</title></head><body>')
+                for i in range(depth):
+                    f.write('<ul><li><a href="t%d.html">T%d</a>' % (i, i))
+                f.write('</li></ul>' * depth + '</body></html>')
+            toc = quietly(dita2confluence.parse_toc, toc_file, tmp)
+        finally:
+            shutil.rmtree(tmp)
+        self.assertEqual(depth + 1, len(toc['flat_toc']))
+        node = toc
+        for i in range(depth):
+            node = node['children'][0]
+        self.assertEqual('T%d' % (depth - 1), node['links'][0]['title'])
+
+
+class StateManifestTest(unittest.TestCase):
+    '''
+    what StateManifest skips on the next run
+    '''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.tmp, 'state.json')
+        self.topic = os.path.join(self.tmp, 'topics', 'a.html')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def manifest(self, space_key='DOC', root_id='1', basedir=None, **kwargs):
+        return quietly(dita2confluence.StateManifest, self.state_file,
+                       space_key, root_id, basedir or self.tmp, **kwargs)
+
+    def published(self):
+        state = self.manifest()
+        state.record_page(self.topic, {"id": "10", "version": "1",
+                                       "title": "A"}, 'page-hash')
+        state.record_attachment(self.topic, '10', 'a.png', 'image-hash')
+        state.record_order('1', ['10', '11'])
+        state.save()
+
+    def test_unchanged(self):
+        self.published()
+        state = self.manifest()
+        self.assertTrue(state.unchanged_page(self.topic, 'page-hash',
+                                             {"id": "10"}))
+        self.assertTrue(state.unchanged_attachment(self.topic, '10',
+                                                   'a.png', 'image-hash'))
+        self.assertTrue(state.unchanged_order('1', ['10', '11']))
+
+    def test_changed(self):
+        self.published()
+        state = self.manifest()
+        self.assertFalse(state.unchanged_page(self.topic, 'new-hash',
+                                              {"id": "10"}))
+        # the page was deleted and created again, or was never published
+        self.assertFalse(state.unchanged_page(self.topic, 'page-hash',
+                                              {"id": "12"}))
+        self.assertFalse(state.unchanged_page(self.topic, 'page-hash', None))
+        self.assertFalse(state.unchanged_attachment(self.topic, '10',
+                                                    'a.png', 'new-hash'))
+        self.assertFalse(state.unchanged_attachment(self.topic, '10',
+                                                    'b.png', 'image-hash'))
+        self.assertFalse(state.unchanged_order('1', ['11', '10']))
+        self.assertFalse(state.unchanged_order('10', []))
+
+    def test_moved_output(self):
+        # sources are kept relative to the directory of the toc
+        self.published()
+        moved = os.path.join(self.tmp, 'moved')
+        state = self.manifest(basedir=moved)
+        self.assertTrue(state.unchanged_page(
+            os.path.join(moved, 'topics', 'a.html'), 'page-hash',
+            {"id": "10"}))
+
+    def test_force(self):
+        self.published()
+        state = self.manifest(force=True)
+        self.assertFalse(state.unchanged_page(self.topic, 'page-hash',
+                                              {"id": "10"}))
+        self.assertFalse(state.unchanged_attachment(self.topic, '10',
+                                                    'a.png', 'image-hash'))
+        self.assertFalse(state.unchanged_order('1', ['10', '11']))
+
+    def test_ignored(self):
+        self.published()
+        for space_key, root_id in (('OTHER', '1'), ('DOC', '2')):
+            state = self.manifest(space_key, root_id)
+            self.assertFalse(state.unchanged_page(self.topic, 'page-hash',
+                                                  {"id": "10"}))
+            self.assertFalse(state.unchanged_order('1', ['10', '11']))
+        for content in ('{"format": 1, "space": "DOC", "pa', '[1, 2]', ''):
+            with open(self.state_file, 'w') as f:
+                f.write(content)
+            state = self.manifest()
+            self.assertFalse(state.unchanged_page(self.topic, 'page-hash',
+                                                  {"id": "10"}))
+            # and is replaced when the manifest is saved
+            state.save()
+            self.assertEqual(
+                'DOC', read_json(self.state_file)['space'])
+
+
+class RepublishTest(unittest.TestCase):
+    '''
+    publishes a manual twice to the mock confluence of the benchmark
+    '''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.index = dita2confluence_bench.generate_output(
+            os.path.join(self.tmp, 'output'), 12)
+        self.confluence = dita2confluence_bench.MockConfluence()
+        self.server = dita2confluence_bench.MockServer(self.confluence)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def publish(self, *extra):
+        '''
+        publish the manual and return the calls confluence received
+        '''
+        self.confluence.calls.clear()
+        script = os.path.join(os.path.dirname(GOLDEN), '..',
+                              'dita2confluence.py')
+        command = [sys.executable, script, '-u', 'user', '-p', 'password',
+                   '-s', 'BENCH', '-r', 'Root', '--url', self.server.url]
+        process = subprocess.Popen(command + list(extra) + [self.index],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        self.assertEqual(0, process.returncode, output)
+        return dict(self.confluence.calls)
+
+    def test_unchanged_skipped(self):
+        calls = self.publish()
+        self.assertEqual(13, calls['storePage'])
+        self.assertEqual(36, calls['addAttachment'])
+        calls = self.publish()
+        for method in ('storePage', 'addAttachment', 'getAttachments',
+                       'getChildren', 'movePage'):
+            self.assertNotIn(method, calls)
+
+    def test_force(self):
+        self.publish()
+        calls = self.publish('--force')
+        self.assertEqual(13, calls['storePage'])
+        self.assertEqual(36, calls['addAttachment'])
+        # the orders are checked again, but they did not change
+        self.assertIn('getChildren', calls)
+        self.assertNotIn('movePage', calls)
+
+
+def moved(current_ids, moves):
+    '''
+    the order of the children after the moves, the way confluence moves
+    them
+    '''
+    order = list(current_ids)
+    for page_id, target_id, position in moves:
+        if page_id in order:
+            order.remove(page_id)
+        index = order.index(target_id)
+        order.insert(index + (position == 'below'), page_id)
+    return order
+
+
+def increasing(current_ids, desired_ids):
+    # length of the longest increasing subsequence, the simple way
+    positions = [current_ids.index(i) for i in desired_ids]
+    longest = []
+    for i, pos in enumerate(positions):
+        longest.append(1 + max([longest[j] for j in range(i)
+                                if positions[j] < pos] or [0]))
+    return max(longest or [0])
+
+
+class PlanMovesTest(unittest.TestCase):
+
+    def check(self, current, desired, expected):
+        moves = dita2confluence.plan_moves(list(current), list(desired))
+        self.assertEqual(expected, moves)
+        order = moved(current, moves)
+        self.assertEqual(list(desired), [i for i in order if i in desired])
+
+    def test_in_order(self):
+        self.check('abcd', 'abcd', [])
+        self.check('', '', [])
+
+    def test_reversed(self):
+        self.check('abcd', 'dcba', [('d', 'a', 'above'),
+                                    ('c', 'd', 'below'),
+                                    ('b', 'c', 'below')])
+
+    def test_one_moved(self):
+        self.check('abcde', 'abdec', [('c', 'e', 'below')])
+        self.check('abcde', 'eabcd', [('e', 'a', 'above')])
+        self.check('abcde', 'bcdea', [('a', 'e', 'below')])
+
+    def test_new_pages(self):
+        # pages that are not listed yet are always moved
+        self.check('ac', 'abcd', [('b', 'a', 'below'), ('d', 'c', 'below')])
+        # order_children lists the pages stored below the parent last
+        current = dita2confluence.stored_order(list('ac'), list('abcd'))
+        self.check(current, 'abcd', [('b', 'a', 'below')])
+
+    def test_pages_outside_toc(self):
+        # the other children of the parent stay where they are
+        self.check('xaybz', 'abc', [('c', 'b', 'below')])
+        self.check('xaybz', 'cba', [('c', 'a', 'above'),
+                                    ('b', 'c', 'below')])
+        self.check('xyz', '', [])
+
+    def test_random_orders(self):
+        # the orders are right, and only the pages off a longest increasing
+        # subsequence are moved
+        rng = random.Random(7)
+        for i in range(1000):
+            desired = range(rng.randint(0, 12))
+            current = desired[:]
+            rng.shuffle(current)
+            moves = dita2confluence.plan_moves(current, desired)
+            self.assertEqual(desired, moved(current, moves))
+            self.assertEqual(len(desired) - increasing(current, desired),
+                             len(moves))
+
+
+class RestServiceTest(unittest.TestCase):
+    '''
+    RestService against the REST api of the mock confluence of the
+    benchmark
+    '''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.confluence = dita2confluence_bench.MockConfluence()
+        self.server = dita2confluence_bench.MockServer(self.confluence)
+        self.server.start()
+        self.pool = dita2confluence.ConnectionPool()
+        fallback = dita2confluence.ConfluenceServer(
+            self.server.url,
+            transport=dita2confluence.PooledTransport(self.pool))
+        self.service = dita2confluence.RestService(
+            self.server.url.replace('/rpc/xmlrpc', ''),
+            dita2confluence.PooledTransport(self.pool), fallback=fallback)
+        self.token = self.service.login('user', 'password')
+        self.root_id = self.confluence.find('Root')['id']
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def create(self, count, parent_id=None):
+        return [self.confluence.create({
+            "title": "Page %d" % (i), "parentId": parent_id or self.root_id,
+            "content": ""})['id'] for i in range(count)]
+
+    def test_paged_listings(self):
+        ids = self.create(250)
+        children = self.service.getChildren(self.token, self.root_id)
+        self.assertEqual(ids, [page['id'] for page in children])
+        self.assertEqual(self.root_id, children[0]['parentId'])
+        self.assertEqual(3, self.confluence.calls['rest.children'])
+        grandchildren = self.create(3, ids[0])
+        descendants = self.service.getDescendents(self.token, self.root_id)
+        self.assertEqual(ids[:1] + grandchildren + ids[1:],
+                         [page['id'] for page in descendants])
+        self.assertEqual(ids[0], descendants[1]['parentId'])
+        pages = self.service.getPages(self.token, 'BENCH')
+        self.assertEqual(255, len(pages))
+
+    def test_store_page(self):
+        page = self.service.storePage(self.token, {
+            "title": "New", "space": "BENCH", "parentId": self.root_id,
+            "content": u"<p>new \u00e9</p>"})
+        self.assertEqual(('New', '1', self.root_id),
+                         (page['title'], page['version'], page['parentId']))
+        page = self.service.getPage(self.token, 'BENCH', 'New')
+        self.assertEqual(u"<p>new \u00e9</p>", page['content'])
+        # an update is sent with the next version
+        page = self.service.storePage(self.token, dict(
+            page, content=u"<p>changed</p>"))
+        self.assertEqual('2', page['version'])
+        # and once more after the page was edited in the meantime
+        self.confluence.storePage(None, dict(
+            self.confluence.pages[page['id']], content=u"<p>edited</p>"))
+        page = self.service.storePage(self.token, dict(
+            page, content=u"<p>again</p>"))
+        self.assertEqual('4', page['version'])
+        self.assertEqual(u"<p>again</p>",
+                         self.confluence.pages[page['id']]['content'])
+
+    def test_faults(self):
+        for call in (lambda: self.service.getPage(self.token, '999'),
+                     lambda: self.service.getPage(self.token, 'BENCH', 'No'),
+                     lambda: self.service.getSpace(self.token, 'NONE')):
+            try:
+                call()
+                self.fail('no fault')
+            except xmlrpclib.Fault as e:
+                self.assertEqual(404, e.faultCode)
+
+    def test_attachments(self):
+        data = ''.join(chr(i) for i in range(256)) + '\r\n--\r\n'
+        path = os.path.join(self.tmp, 'large file.bin')
+        with open(path, 'wb') as f:
+            f.write(data * 1000)
+        page_id = self.create(1)[0]
+        attachment = {"fileName": "a \"b\".bin", "comment": "sha1:1",
+                      "contentType": "application/octet-stream"}
+        # the multipart body holds the file as it is
+        body = dita2confluence.MultipartAttachment(attachment, data=data)
+        sent = ''.join(body.chunks())
+        self.assertEqual(len(body), len(sent))
+        fields = dita2confluence_bench.parse_multipart(sent)
+        self.assertEqual(('a %22b%22.bin', data), fields['file'])
+        self.assertEqual((None, 'sha1:1'), fields['comment'])
+
+        added = self.service.addAttachment(self.token, page_id, attachment,
+                                           xmlrpclib.Binary(data))
+        self.assertEqual((str(len(data)), 'sha1:1'),
+                         (added['fileSize'], added['comment']))
+        streamed = dita2confluence.StreamedAttachmentRequest(
+            self.token, page_id, dict(attachment, fileName='large file.bin'),
+            path)
+        self.service.call_streamed(streamed)
+        attachments = dict(
+            (a['fileName'], a) for a in
+            self.service.getAttachments(self.token, page_id))
+        self.assertEqual(str(len(data) * 1000),
+                         attachments['large file.bin']['fileSize'])
+        self.assertEqual('sha1:1', attachments['large file.bin']['comment'])
+
+    def test_move_and_remove(self):
+        ids = self.create(3)
+        self.assertTrue(self.service.movePage(self.token, ids[2], ids[0],
+                                              'above'))
+        self.assertEqual([ids[2], ids[0], ids[1]],
+                         self.confluence.children[self.root_id])
+        self.assertEqual(1, self.confluence.calls['rest.move'])
+        self.assertNotIn('movePage', self.confluence.calls)
+        self.service.removePage(self.token, ids[0])
+        self.assertEqual([ids[2], ids[1]],
+                         self.confluence.children[self.root_id])
+
+    def test_move_with_xmlrpc(self):
+        # confluence before version 7 has no move endpoint
+        self.server.rest.move_supported = False
+        ids = self.create(3)
+        self.assertTrue(quietly(self.service.movePage, self.token, ids[2],
+                                ids[0], 'above'))
+        self.assertTrue(self.service.movePage(self.token, ids[1], ids[2],
+                                              'above'))
+        self.assertEqual([ids[1], ids[2], ids[0]],
+                         self.confluence.children[self.root_id])
+        # the REST api is asked once, the fallback logs in once
+        self.assertFalse(self.service.shared['rest_move'])
+        self.assertEqual(2, self.confluence.calls['movePage'])
+        self.assertEqual(1, self.confluence.calls['login'])
+
+
+class JournalTest(unittest.TestCase):
+    '''
+    the journal of StateManifest, replayed with --resume after a run died
+    '''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.tmp, 'state.json')
+        self.journal_file = os.path.join(self.tmp, 'journal.jsonl')
+        self.topic = os.path.join(self.tmp, 'topics', 'a.html')
+        self.other_topic = os.path.join(self.tmp, 'topics', 'b.html')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def manifest(self, space_key='DOC', root_id='1', **kwargs):
+        return quietly(dita2confluence.StateManifest, self.state_file,
+                       space_key, root_id, self.tmp,
+                       journal_path=self.journal_file, **kwargs)
+
+    def interrupted_run(self):
+        # a run that published a page, its attachment and the order below
+        # the root, and died while it journaled the second page
+        state = self.manifest()
+        state.record_page(self.topic, {"id": "10", "version": "1",
+                                       "title": "A"}, 'page-hash')
+        state.record_attachment(self.topic, '10', 'a.png', 'image-hash')
+        state.record_order('1', ['10', '11'])
+        state.record_page(self.other_topic, {"id": "11", "version": "1",
+                                             "title": "B"}, 'page-hash')
+        state.close()
+        with open(self.journal_file, 'r+') as f:
+            f.truncate(os.path.getsize(self.journal_file) - 20)
+
+    def test_resume(self):
+        self.interrupted_run()
+        # the replayed records count as unchanged even with --force
+        state = self.manifest(resume=True, force=True)
+        self.assertTrue(state.unchanged_page(self.topic, 'page-hash',
+                                             {"id": "10"}))
+        self.assertTrue(state.unchanged_attachment(self.topic, '10',
+                                                   'a.png', 'image-hash'))
+        self.assertTrue(state.unchanged_order('1', ['10', '11']))
+        # the cut off record was not finished
+        self.assertFalse(state.unchanged_page(self.other_topic, 'page-hash',
+                                              {"id": "11"}))
+        self.assertFalse(state.unchanged_order('1', ['11', '10']))
+
+        # the journal continues after the last complete record
+        state.record_page(self.other_topic, {"id": "11", "version": "1",
+                                             "title": "B"}, 'page-hash')
+        state.close()
+        state = self.manifest(resume=True)
+        self.assertTrue(state.unchanged_page(self.topic, 'page-hash',
+                                             {"id": "10"}))
+        self.assertTrue(state.unchanged_page(self.other_topic, 'page-hash',
+                                             {"id": "11"}))
+
+    def test_resume_other_space_or_root(self):
+        for space_key, root_id in (('OTHER', '1'), ('DOC', '2')):
+            self.interrupted_run()
+            state = self.manifest(space_key, root_id, resume=True)
+            self.assertFalse(state.unchanged_page(self.topic, 'page-hash',
+                                                  {"id": "10"}))
+            self.assertFalse(state.unchanged_order('1', ['10', '11']))
+            state.close()
+            self.assertEqual(0, os.path.getsize(self.journal_file))
+
+    def test_journal_of_previous_run_discarded(self):
+        self.interrupted_run()
+        state = self.manifest()
+        self.assertFalse(state.unchanged_page(self.topic, 'page-hash',
+                                              {"id": "10"}))
+        state.close()
+        self.assertEqual(0, os.path.getsize(self.journal_file))
+
+    def test_save_empties_journal(self):
+        state = self.manifest()
+        state.record_page(self.topic, {"id": "10", "version": "1",
+                                       "title": "A"}, 'page-hash')
+        state.save()
+        state.close()
+        self.assertEqual(0, os.path.getsize(self.journal_file))
+        state = self.manifest(resume=True)
+        self.assertTrue(state.unchanged_page(self.topic, 'page-hash',
+                                             {"id": "10"}))
+
+
+class ExpiringConfluence(object):
+    '''
+    confluence2 methods that accept only the token of the latest login
+    '''
+
+    def __init__(self):
+        self.tokens = []
+        self.calls = []
+
+    def login(self, user, password):
+        self.tokens.append('token-%d' % len(self.tokens))
+        return self.tokens[-1]
+
+    def getPage(self, token, space_key, title):
+        self.calls.append(token)
+        if token != self.tokens[-1]:
+            raise xmlrpclib.Fault(0, 'User not authenticated or session '
+                                  'expired. Call login() to open a new '
+                                  'session')
+        if title == 'Missing':
+            raise xmlrpclib.Fault(0, 'page not found')
+        return {"id": "10", "space": space_key, "title": title}
+
+
+class ExpiringService(object):
+
+    def __init__(self):
+        self.confluence2 = ExpiringConfluence()
+
+
+class SessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.service = ExpiringService()
+        self.credentials = dita2confluence.Credentials('user', 'password')
+        self.session = dita2confluence.ConfluenceSession(self.service,
+                                                         self.credentials)
+
+    def test_login_again_after_expired_session(self):
+        token = self.session.login()
+        # another login ends the session on the server
+        self.service.confluence2.login('user', 'password')
+        page = quietly(self.session.confluence2.getPage, token, 'DOC', 'A')
+        self.assertEqual('10', page['id'])
+        self.assertEqual(['token-0', 'token-2'],
+                         self.service.confluence2.calls)
+        self.assertEqual('token-2', self.credentials.token)
+        # later calls with the old token use the new session at once
+        quietly(self.session.confluence2.getPage, token, 'DOC', 'B')
+        self.assertEqual(['token-0', 'token-2', 'token-2'],
+                         self.service.confluence2.calls)
+
+    def test_other_faults_are_raised(self):
+        token = self.session.login()
+        self.assertRaises(xmlrpclib.Fault, self.session.confluence2.getPage,
+                          token, 'DOC', 'Missing')
+        self.assertEqual(['token-0'], self.service.confluence2.tokens)
+
+
+class FakeClock(object):
+    '''
+    a clock that only advances when the test sleeps
+    '''
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+def server_error(status, headers=None):
+    return xmlrpclib.ProtocolError('localhost/rpc/xmlrpc', status, 'error',
+                                   headers or {})
+
+
+class ConversionCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'cache', 'cache.sqlite')
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def cache(self, max_bytes=1 << 20):
+        return dita2confluence.ConversionCache(self.path, max_bytes,
+                                               clock=self.clock)
+
+    def result(self, title):
+        return {"title": title, "content": u"<p>%s</p>" % title,
+                "images": [], "attachments": [], "links": []}
+
+    def topic(self, name):
+        return os.path.join(self.tmp, name + '.html')
+
+    def test_hit_after_write(self):
+        cache = self.cache()
+        self.assertIsNone(cache.get(self.topic('a'), 'hash-1'))
+        cache.put(self.topic('a'), 'hash-1', self.result('A'))
+        self.assertEqual(self.result('A'),
+                         cache.get(self.topic('a'), 'hash-1'))
+        cache.close()
+        # and in the next run
+        cache = self.cache()
+        self.assertEqual(self.result('A'),
+                         cache.get(self.topic('a'), 'hash-1'))
+        self.assertIsNone(cache.get(self.topic('a'), 'hash-2'))
+        self.assertIsNone(cache.get(self.topic('b'), 'hash-1'))
+        self.assertEqual((1, 2), (cache.hits, cache.misses))
+        cache.close()
+
+    def test_miss_after_converter_change(self):
+        cache = self.cache()
+        cache.put(self.topic('a'), 'hash-1', self.result('A'))
+        version = dita2confluence.CONVERTER_VERSION
+        dita2confluence.CONVERTER_VERSION = version + 1
+        try:
+            self.assertIsNone(cache.get(self.topic('a'), 'hash-1'))
+        finally:
+            dita2confluence.CONVERTER_VERSION = version
+        self.assertIsNotNone(cache.get(self.topic('a'), 'hash-1'))
+        cache.close()
+
+    def test_eviction(self):
+        cache = self.cache()
+        for name in 'abc':
+            cache.put(self.topic(name), 'hash', self.result(name.upper()))
+            self.clock.sleep(1)
+        cache.close()
+        size = len(json.dumps(self.result('A')))
+        # "a" is used again, so "b" is now the oldest
+        cache = self.cache(max_bytes=3 * size)
+        cache.get(self.topic('a'), 'hash')
+        self.clock.sleep(1)
+        cache.put(self.topic('d'), 'hash', self.result('D'))
+        quietly(cache.close)
+        cache = self.cache()
+        self.assertIsNone(cache.get(self.topic('b'), 'hash'))
+        for name in 'acd':
+            self.assertEqual(self.result(name.upper()),
+                             cache.get(self.topic(name), 'hash'))
+            self.clock.sleep(1)
+        cache.close()
+        # down to the limit, oldest first
+        cache = self.cache(max_bytes=size)
+        quietly(cache.close)
+        cache = self.cache()
+        self.assertIsNone(cache.get(self.topic('a'), 'hash'))
+        self.assertIsNone(cache.get(self.topic('c'), 'hash'))
+        self.assertIsNotNone(cache.get(self.topic('d'), 'hash'))
+        cache.close()
+
+
+class WorkerPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.services = []
+        self.running = {}
+        self.most = {}
+        self.done = []
+
+    def service(self):
+        with self.lock:
+            self.services.append('service-%d' % len(self.services))
+            return self.services[-1]
+
+    def task(self, service, name, kinds):
+        with self.lock:
+            for kind in kinds:
+                self.running[kind] = self.running.get(kind, 0) + 1
+                self.most[kind] = max(self.most.get(kind, 0),
+                                      self.running[kind])
+        time.sleep(0.02)
+        with self.lock:
+            for kind in kinds:
+                self.running[kind] -= 1
+            self.done.append((service, name))
+
+    def test_limits(self):
+        pool = dita2confluence.WorkerPool(
+            6, self.service, limits={'upload': 1, 'store': 2, 'DOC': 3})
+        for i in range(8):
+            pool.submit('upload %d' % i, self.task, 'upload %d' % i,
+                        ('all', 'upload'), kind='upload')
+            pool.submit('store %d' % i, self.task, 'store %d' % i,
+                        ('all', 'store'), kind='store')
+            # counts against the limit of both
+            pool.submit('delete %d' % i, self.task, 'delete %d' % i,
+                        ('all', 'delete', 'DOC'), kind=('delete', 'DOC'))
+            pool.submit('other %d' % i, self.task, 'other %d' % i,
+                        ('all', 'DOC'), kind='DOC')
+        pool.join()
+        pool.close()
+        self.assertEqual(32, len(self.done))
+        for kind, limit in (('upload', 1), ('store', 2), ('delete', 3),
+                            ('DOC', 3), ('all', 6)):
+            self.assertTrue(1 <= self.most[kind] <= limit, (kind, self.most))
+        # while the workers were busy with tasks of several kinds
+        self.assertTrue(self.most['all'] >= 4, self.most)
+        # every worker has its own service
+        self.assertEqual(6, len(self.services))
+        self.assertTrue(set(service for service, name in self.done) <=
+                        set(self.services))
+
+    def test_failures(self):
+        pool = dita2confluence.WorkerPool(2, self.service)
+        failures = []
+
+        def fail(service, error):
+            raise error
+
+        def spawn(service):
+            # tasks may submit further tasks
+            for i in range(3):
+                pool.submit('spawned %d' % i, self.task, 'spawned %d' % i,
+                            ())
+            pool.submit('spawned failure', fail, KeyError('spawned'))
+
+        error = ValueError('failed')
+        pool.submit('failure', fail, error)
+        for i in range(5):
+            pool.submit('task %d' % i, self.task, 'task %d' % i, ())
+        pool.submit('own failure', fail, error, failures=failures)
+        pool.submit('spawn', spawn)
+        quietly(pool.join)
+        pool.close()
+        self.assertEqual(8, len(self.done))
+        self.assertEqual([('failure', error)], pool.failures[:1])
+        self.assertEqual(['failure', 'spawned failure'],
+                         [d for d, e in pool.failures])
+        self.assertEqual([('own failure', error)], failures)
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_trace_events(self):
+        metrics = dita2confluence.Metrics()
+        metrics.enabled = True
+        with metrics.span('parse_toc'):
+            pass
+
+        def work():
+            with metrics.span('store', 'page'):
+                pass
+            metrics.record_rpc('storePage', time.time(), 0.1, 10, 20)
+        threads = [threading.Thread(target=work, name='worker-%d' % i)
+                   for i in range(2)]
+        for t in threads:
+            t.start()
+            t.join()
+        # spans of the conversion processes
+        for i in range(2):
+            metrics.add_span('convert', 'page', time.time(), 0.1, 0.1,
+                             pid=1234, thread='convert')
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'metrics.json')
+            metrics.write(path)
+            events = read_json(path)['traceEvents']
+        finally:
+            shutil.rmtree(tmp)
+
+        names = dict(((e['pid'], e['tid']), e['args']['name'])
+                     for e in events if e['ph'] == 'M')
+        self.assertEqual(4, len(names))
+        self.assertEqual(4, len([e for e in events if e['ph'] == 'M']))
+        spans = [e for e in events if e['ph'] == 'X']
+        self.assertEqual(7, len(spans))
+        for e in spans:
+            self.assertIsInstance(e['tid'], int)
+        self.assertEqual(
+            [('parse_toc', threading.current_thread().name),
+             ('store', 'worker-0'), ('storePage', 'worker-0'),
+             ('store', 'worker-1'), ('storePage', 'worker-1'),
+             ('convert', 'convert'), ('convert', 'convert')],
+            [(e['name'], names[e['pid'], e['tid']]) for e in spans])
+        self.assertEqual(1234, spans[-1]['pid'])
+
+
+class AdaptiveLimitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limit = dita2confluence.AdaptiveLimit(8, clock=self.clock)
+
+    def test_halved_on_errors(self):
+        first = self.limit.acquire()
+        second = self.limit.acquire()
+        self.clock.sleep(1)
+        quietly(self.limit.failed, server_error(500), first)
+        self.assertEqual(4, self.limit.limit)
+        # a request sent before the decrease does not shrink it again
+        quietly(self.limit.failed, socket.timeout(), second)
+        self.assertEqual(4, self.limit.limit)
+        for expected in (2, 1, 1):
+            self.clock.sleep(1)
+            quietly(self.limit.failed, server_error(502),
+                    self.limit.acquire())
+            self.assertEqual(expected, self.limit.limit)
+        self.assertEqual(5, self.limit.errors)
+        self.assertEqual(1, self.limit.lowest)
+        self.assertEqual(0, self.limit.in_flight)
+
+    def test_overloaded(self):
+        started = self.limit.acquire()
+        delay = quietly(self.limit.overloaded,
+                        server_error(503, {'Retry-After': '7'}), started, 0)
+        self.assertEqual(7, delay)
+        self.assertEqual(4, self.limit.limit)
+        self.assertEqual(1, self.limit.throttled)
+        # without Retry-After, an exponential backoff with jitter
+        self.clock.sleep(1)
+        delay = quietly(self.limit.overloaded, server_error(429),
+                        self.limit.acquire(), 2)
+        self.assertTrue(2 <= delay <= 4, delay)
+        self.assertEqual(2, self.limit.limit)
+
+    def test_grows_back(self):
+        quietly(self.limit.failed, server_error(500), self.limit.acquire())
+        self.assertEqual(4, self.limit.limit)
+        # by one for every "limit" successful requests
+        for expected in (4, 4, 4, 4, 5):
+            self.limit.acquire()
+            self.limit.release()
+            self.assertEqual(expected, int(self.limit.limit))
+        for i in range(100):
+            self.limit.acquire()
+            self.limit.release()
+        self.assertEqual(8, self.limit.limit)
+
+    def test_slowed_down(self):
+        for i in range(5):
+            self.limit.acquire()
+            self.limit.release(method='getPage', seconds=0.1)
+        self.assertEqual(8, self.limit.limit)
+        self.limit.acquire()
+        self.limit.release(method='getPage', seconds=2)
+        self.assertEqual(7, self.limit.limit)
+        # at most once per round trip
+        self.limit.acquire()
+        self.limit.release(method='getPage', seconds=2)
+        self.assertEqual(7, self.limit.limit)
+        self.clock.sleep(2)
+        self.limit.acquire()
+        self.limit.release(method='getPage', seconds=2)
+        self.assertEqual(6, self.limit.limit)
+        self.assertEqual(2, self.limit.slowed)
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def bucket(self, rate, burst):
+        return dita2confluence.TokenBucket(rate, burst, clock=self.clock,
+                                           sleep=self.clock.sleep)
+
+    def test_unlimited(self):
+        bucket = self.bucket(0, 1)
+        for i in range(100):
+            bucket.acquire()
+        self.assertEqual([], self.clock.slept)
+
+    def test_delay_and_refill(self):
+        bucket = self.bucket(10, 2)
+        # the burst passes at once
+        bucket.acquire()
+        bucket.acquire()
+        self.assertEqual([], self.clock.slept)
+        # then one request per 0.1 seconds
+        for i in range(5):
+            bucket.acquire()
+        self.assertEqual(5, len(self.clock.slept))
+        for delay in self.clock.slept:
+            self.assertAlmostEqual(0.1, delay)
+        self.assertEqual(5, bucket.waits)
+        self.assertAlmostEqual(0.5, bucket.waited)
+        # a pause refills the bucket up to the burst
+        self.clock.sleep(60)
+        del self.clock.slept[:]
+        bucket.acquire()
+        bucket.acquire()
+        self.assertEqual([], self.clock.slept)
+        bucket.acquire()
+        self.assertEqual(1, len(self.clock.slept))
+        self.assertAlmostEqual(0.1, self.clock.slept[0])
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = dita2confluence.CircuitBreaker(3, 30,
+                                                      clock=self.clock)
+
+    def fail(self, times=1):
+        for i in range(times):
+            self.breaker.before()
+            quietly(self.breaker.failure)
+
+    def test_opens_after_threshold(self):
+        self.fail(2)
+        self.breaker.before()
+        self.breaker.success()
+        # a success starts the count again
+        self.fail(2)
+        self.assertEqual(0, self.breaker.opened)
+        self.fail()
+        self.assertEqual(1, self.breaker.opened)
+        self.assertRaises(dita2confluence.CircuitOpenError,
+                          self.breaker.before)
+        self.clock.sleep(29)
+        self.assertRaises(dita2confluence.CircuitOpenError,
+                          self.breaker.before)
+        self.assertEqual(2, self.breaker.rejected)
+
+    def test_half_open(self):
+        self.fail(3)
+        self.clock.sleep(30)
+        # a single trial call after the cooldown
+        self.breaker.before()
+        self.assertRaises(dita2confluence.CircuitOpenError,
+                          self.breaker.before)
+        # that fails and opens the circuit for another cooldown
+        quietly(self.breaker.failure)
+        self.assertEqual(1, self.breaker.opened)
+        self.clock.sleep(29)
+        self.assertRaises(dita2confluence.CircuitOpenError,
+                          self.breaker.before)
+        self.clock.sleep(1)
+        self.breaker.before()
+        # the trial succeeds and closes the circuit
+        quietly(self.breaker.success)
+        self.breaker.before()
+        self.breaker.before()
+        self.fail(2)
+        self.breaker.before()
+
+    def test_disabled(self):
+        breaker = dita2confluence.CircuitBreaker(0, 30, clock=self.clock)
+        for i in range(100):
+            breaker.before()
+            breaker.failure()
+        self.assertEqual(0, breaker.opened)
+
+
+if __name__ == '__main__':
+    unittest.main()